@@ -1,12 +1,25 @@
 import inspect
 import unittest
 import os
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+import nibabel as nib
+import numpy as np
 
 from qmenta.sdk.tool_maker.context import TestFileInput
 from qmenta.sdk.tool_maker.modalities import Modality, Tag
 import sys
 sys.path.append("../../")
 from qmenta_sdk_tool_maker_example.tool import QmentaSdkToolMakerExample
+from qmenta_sdk_tool_maker_example.metadata import MetadataBuffer, MetadataCache
+from qmenta_sdk_tool_maker_example.pipeline import StageScheduler
+from qmenta_sdk_tool_maker_example.preview import build_preview_pyramid
+from qmenta_sdk_tool_maker_example.progress import ProgressReporter
+from qmenta_sdk_tool_maker_example.qc import run_qc
 
 
 class TestTool(unittest.TestCase):
@@ -41,6 +54,366 @@ class TestTool(unittest.TestCase):
         )
 
 
+class TestStageScheduler(unittest.TestCase):
+    """Tests for the stage scheduler used in the run method of the tool."""
+
+    def test_independent_stages_run_concurrently(self):
+        scheduler = StageScheduler()
+        scheduler.add_stage("first", lambda: time.sleep(0.2) or 1, outputs=["a"])
+        scheduler.add_stage("second", lambda: time.sleep(0.2) or 2, outputs=["b"])
+        scheduler.add_stage("total", lambda a, b: a + b, inputs=["a", "b"], outputs=["total"])
+        values = scheduler.run()
+        self.assertEqual(values["total"], 3)
+        first, second = scheduler.stages[:2]
+        self.assertTrue(first.start < second.end and second.start < first.end)  # the two sleeps overlap
+        path, duration = scheduler.critical_path()
+        self.assertEqual(path[-1], "total")
+        self.assertGreaterEqual(duration, 0.2)
+
+    def test_failing_stage_stops_dependants(self):
+        calls = []
+        scheduler = StageScheduler()
+        scheduler.add_stage("broken", lambda: 1 / 0, outputs=["a"])
+        scheduler.add_stage("dependant", lambda a: calls.append(a), inputs=["a"])
+        with self.assertRaises(ZeroDivisionError):
+            scheduler.run()
+        self.assertEqual(calls, [])
+
+    def test_circular_dependencies(self):
+        scheduler = StageScheduler()
+        scheduler.add_stage("first", lambda b: b, inputs=["b"], outputs=["a"])
+        scheduler.add_stage("second", lambda a: a, inputs=["a"], outputs=["b"])
+        with self.assertRaises(ValueError):
+            scheduler.run()
+
+
+class CountingContext:
+    """Local stand-in for the analysis context that counts the calls to the platform."""
+
+    def __init__(self, delay=0.0):
+        self.analysis_id = 1
+        self.delay = delay
+        self.calls = {}
+
+    def _count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        time.sleep(self.delay)
+
+    def fetch_analysis_data(self):
+        self._count("fetch_analysis_data")
+        return {"patient_secret_name": "subject", "ssid": "1"}
+
+    def set_metadata_value(self, key, value):
+        self._count("set_metadata_value")
+
+    def set_progress(self, message=None):
+        self._count("set_progress")
+        self.last_progress = message
+
+
+class TestMetadataCache(unittest.TestCase):
+    """Tests for the cache of the metadata requested to the platform."""
+
+    def test_concurrent_requests_are_coalesced(self):
+        context = CountingContext(delay=0.1)
+        cache = MetadataCache()
+        results = []
+        workers = [
+            threading.Thread(target=lambda: results.append(cache.fetch_analysis_data(context))) for _ in range(8)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(context.calls["fetch_analysis_data"], 1)
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(result["ssid"] == "1" for result in results))
+
+    def test_entries_expire(self):
+        now = [0.0]
+        context = CountingContext()
+        cache = MetadataCache(ttl=10, clock=lambda: now[0])
+        cache.fetch_analysis_data(context)
+        cache.fetch_analysis_data(context)
+        self.assertEqual(context.calls["fetch_analysis_data"], 1)
+        now[0] = 11.0
+        cache.fetch_analysis_data(context)
+        self.assertEqual(context.calls["fetch_analysis_data"], 2)
+
+    def test_expired_entries_are_evicted(self):
+        now = [0.0]
+        cache = MetadataCache(ttl=10, clock=lambda: now[0])
+        first, second = CountingContext(), CountingContext()
+        second.analysis_id = 2
+        cache.fetch_analysis_data(first)
+        now[0] = 11.0
+        cache.fetch_analysis_data(second)  # storing a new value evicts the expired analysis
+        self.assertEqual(list(cache._entries), [("analysis_data", 2)])
+
+    def test_files_of_different_analyses_are_not_shared(self):
+        class FileHandler:
+            def __init__(self, modality):
+                self.file_path = "input_folder/input/T1.nii.gz"  # same local path in both analyses
+                self.modality = modality
+
+            def get_file_modality(self):
+                return self.modality
+
+        cache = MetadataCache()
+        first, second = CountingContext(), CountingContext()
+        second.analysis_id = 2
+        self.assertEqual(cache.get_file_modality(first, FileHandler("T1")), "T1")
+        self.assertEqual(cache.get_file_modality(second, FileHandler("T2")), "T2")
+        self.assertEqual(cache.get_file_modality(first, FileHandler("T2")), "T1")
+
+    def test_no_caching_without_analysis_id(self):
+        context = CountingContext()
+        context.analysis_id = None
+        cache = MetadataCache()
+        cache.fetch_analysis_data(context)
+        cache.fetch_analysis_data(context)
+        self.assertEqual(context.calls["fetch_analysis_data"], 2)
+
+    def test_errors_are_not_cached(self):
+        def unavailable():
+            raise RuntimeError("Platform unavailable")
+
+        cache = MetadataCache()
+        with self.assertRaises(RuntimeError):
+            cache.get("key", unavailable)
+        self.assertEqual(cache.get("key", lambda: 1), 1)
+
+
+class TestMetadataBuffer(unittest.TestCase):
+    """Tests for the buffer of the session metadata written during a run."""
+
+    def test_values_are_deduplicated(self):
+        context = CountingContext()
+        with MetadataBuffer(context) as metadata:
+            for i in range(10):
+                metadata.set_metadata_value(key="volume", value=i)
+            metadata.set_metadata_value(key="snr", value=20)
+            self.assertNotIn("set_metadata_value", context.calls)
+        self.assertEqual(context.calls["set_metadata_value"], 2)
+        self.assertEqual(metadata.round_trips_saved, 9)
+
+    def test_flush_on_failure(self):
+        context = CountingContext()
+        with self.assertRaises(RuntimeError):
+            with MetadataBuffer(context) as metadata:
+                metadata.set_metadata_value(key="qc_passed", value=0)
+                raise RuntimeError("Processing failed")
+        self.assertEqual(context.calls["set_metadata_value"], 1)
+
+    def test_failed_write_keeps_remaining_values(self):
+        context = CountingContext()
+        written = []
+
+        def set_metadata_value(key, value):
+            if key == "snr" and "snr" not in context.calls:
+                context.calls["snr"] = 1
+                raise ConnectionError("Platform unavailable")
+            written.append(key)
+
+        context.set_metadata_value = set_metadata_value
+        metadata = MetadataBuffer(context)
+        metadata.set_metadata_value(key="volume", value=1)
+        metadata.set_metadata_value(key="snr", value=20)
+        metadata.set_metadata_value(key="qc_passed", value=1)
+        with self.assertRaises(ConnectionError):
+            metadata.flush()
+        self.assertEqual(written, ["volume"])
+        metadata.flush()
+        self.assertEqual(written, ["volume", "snr", "qc_passed"])
+
+    def test_flush_error_does_not_hide_run_error(self):
+        context = CountingContext()
+        context.set_metadata_value = lambda key, value: 1 / 0
+        with self.assertRaises(RuntimeError):
+            with MetadataBuffer(context) as metadata:
+                metadata.set_metadata_value(key="qc_passed", value=0)
+                raise RuntimeError("Processing failed")
+
+
+class TestProgressReporter(unittest.TestCase):
+    """Tests for the throttled progress reporter."""
+
+    def test_updates_are_throttled(self):
+        context = CountingContext()
+        n_slices = 100000
+        with ProgressReporter(context, max_per_second=10) as progress:
+            for i in range(n_slices):
+                progress.update(stage="Segmentation", fraction=(i + 1) / n_slices)
+        self.assertLessEqual(context.calls["set_progress"], 20)
+        self.assertEqual(context.last_progress, "Segmentation (100%)")
+
+    def test_first_update_of_each_stage_is_sent(self):
+        context = CountingContext()
+        with ProgressReporter(context, max_per_second=0.1) as progress:
+            progress.update(stage="Downloading input data")
+            self.assertEqual(context.last_progress, "Downloading input data")
+            progress.update(stage="Processing", fraction=0.5)
+            self.assertEqual(context.last_progress, "Processing (50%)")
+            progress.update(stage="Processing", fraction=0.6)  # throttled
+            self.assertEqual(context.calls["set_progress"], 2)
+
+    def test_concurrent_stages_keep_their_start_time(self):
+        now = [0.0]
+        context = CountingContext()
+        progress = ProgressReporter(context, clock=lambda: now[0])
+        progress.update(stage="Preview")
+        now[0] = 10.0
+        progress.update(stage="Quality control")
+        progress.update(stage="Quality control", fraction=0.5)
+        self.assertEqual(progress._latest[3], 0.0)  # elapsed since "Quality control" started, not since "Preview"
+
+    def test_eta(self):
+        self.assertEqual(ProgressReporter.format("Segmentation", "slice 25", 0.25, 10), "Segmentation: slice 25 (25%, ETA 30s)")
+
+
+class TestQualityControl(unittest.TestCase):
+    """Tests for the multi-modality QC statistics."""
+
+    def test_statistics_per_modality(self):
+        folder = tempfile.mkdtemp()
+        volume = np.zeros((20, 20, 20), dtype=np.float32)
+        volume[5:15] = 10  # background
+        volume[8:12] = 200  # foreground
+        paths = {}
+        for modality, data in (("T1", volume), ("DWI", np.stack([volume, volume / 2], axis=-1))):
+            paths[modality] = os.path.join(folder, f"{modality}.nii.gz")
+            nib.save(nib.Nifti1Image(data, np.eye(4)), paths[modality])
+
+        qc_stats = run_qc(paths, hist_start=50, hist_end=400)
+        self.assertEqual(list(qc_stats), ["T1", "DWI"])
+        self.assertEqual(qc_stats["DWI"]["shape"], (20, 20, 20))  # first volume only
+        self.assertEqual(qc_stats["T1"]["foreground_voxels"], 4 * 20 * 20)
+        self.assertEqual(qc_stats["T1"]["foreground_mean"], 200)
+        self.assertEqual(sum(qc_stats["T1"]["histogram_counts"]), 4 * 20 * 20)
+
+    def test_snr_from_air_background(self):
+        folder = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        sigma = 5.0
+        # Magnitude of complex Gaussian noise: Rayleigh distributed background
+        volume = np.abs(rng.normal(0, sigma, (40, 40, 40)) + 1j * rng.normal(0, sigma, (40, 40, 40)))
+        volume[10:30, 10:30, 10:30] += 500  # head
+        path = os.path.join(folder, "T1.nii.gz")
+        nib.save(nib.Nifti1Image(volume.astype(np.float32), np.eye(4)), path)
+
+        stats = run_qc({"T1": path}, hist_start=50, hist_end=400)["T1"]
+        self.assertAlmostEqual(stats["noise_std"], sigma, delta=0.5)
+        self.assertAlmostEqual(stats["snr"], 500 / sigma, delta=10)
+
+
+class TestPreviewPyramid(unittest.TestCase):
+    """Tests for the downsampled previews loaded by the viewer."""
+
+    def test_block_averaged_levels(self):
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, "T1.nii.gz")
+        affine = np.diag([0.5, 0.5, 0.5, 1])
+        image = nib.Nifti1Image(np.arange(8 ** 3, dtype=np.float32).reshape(8, 8, 8), affine)
+        image.set_qform(affine, code=1)  # scanner coordinates
+        image.set_sform(affine, code=0)
+        nib.save(image, path)
+
+        pyramid = build_preview_pyramid(path, folder, prefix="T1")
+        self.assertEqual([factor for factor, _ in pyramid], [2, 4])
+        level_2x, level_4x = (nib.load(level_path) for _, level_path in pyramid)
+        self.assertEqual(level_2x.shape, (4, 4, 4))
+        self.assertEqual(level_4x.shape, (2, 2, 2))
+        self.assertEqual(level_4x.header.get_zooms(), (2, 2, 2))
+        # The first 4x voxel is the mean of the first 4x4x4 block
+        self.assertAlmostEqual(level_4x.get_fdata()[0, 0, 0], 109.5, places=3)
+        # Voxel centres are shifted to the centre of the averaged block
+        np.testing.assert_allclose(level_4x.affine[:3, 3], [0.75, 0.75, 0.75])
+        for level in (level_2x, level_4x):
+            self.assertEqual(int(level.header["qform_code"]), 1)
+            self.assertEqual(int(level.header["sform_code"]), 0)
+
+    def test_shapes_are_padded(self):
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, "DWI.nii.gz")
+        nib.save(nib.Nifti1Image(np.ones((5, 6, 7, 3), dtype=np.float32), np.eye(4)), path)
+
+        pyramid = build_preview_pyramid(path, folder, prefix="DWI")
+        self.assertEqual(nib.load(pyramid[-1][1]).shape, (2, 2, 2, 3))
+
+
+class StandInFile:
+    """Local stand-in for the handler of an input file."""
+
+    def __init__(self, file_path, modality):
+        self.file_path = file_path
+        self.modality = modality
+
+    def get_file_modality(self):
+        return self.modality
+
+    def get_file_tags(self):
+        return set()
+
+    def get_file_info(self):
+        return {}
+
+
+class RunContext(CountingContext):
+    """Local stand-in for the analysis context of a whole run, the uploads are only counted."""
+
+    def __init__(self, t1_path):
+        super().__init__()
+        self.inputs = SimpleNamespace(
+            input=SimpleNamespace(c_T1=[StandInFile(t1_path, "T1")]), hist_start=50, hist_end=400
+        )
+
+    def upload_file(self, source_file_path, destination_path, **kwargs):
+        self._count("upload_file")
+
+
+@unittest.skipUnless(os.environ.get("RUN_BENCHMARKS"), "Set RUN_BENCHMARKS=1 to run the benchmarks")
+class TestPreviewBenchmark(unittest.TestCase):
+    """
+    Measures the cost of the preview pyramid on a 7T-like T1 (320 x 384 x 384 int16 voxels of 0.5 mm).
+    The previews are generated concurrently with the QC, so their cost is the wall time they add to the tool run:
+    the run is timed with and without previews (the platform is replaced by a local stand-in context).
+    """
+
+    MAX_ADDED_FRACTION = 0.25  # the previews must add less than 25% to the run time
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        os.environ["WORKDIR"] = self.folder
+        rng = np.random.default_rng(0)
+        shape = (320, 384, 384)
+        y, z = np.ogrid[:shape[1], :shape[2]]
+        volume = np.empty(shape, dtype=np.int16)
+        for x in range(shape[0]):  # slice by slice, to keep the memory of the benchmark low
+            head = ((x - 160) / 130) ** 2 + ((y - 192) / 160) ** 2 + ((z - 192) / 150) ** 2 < 1
+            volume[x] = rng.rayleigh(5, shape[1:]) + 400 * head  # Rayleigh noise in the air background
+        self.t1_path = os.path.join(self.folder, "T1.nii.gz")
+        nib.save(nib.Nifti1Image(volume, np.diag([0.5, 0.5, 0.5, 1])), self.t1_path)
+
+    def timed_run(self):
+        context = RunContext(self.t1_path)
+        tool = QmentaSdkToolMakerExample()
+        tool.prepare_inputs = lambda context, logger: setattr(tool, "inputs", context.inputs)
+        start = time.perf_counter()
+        tool.run(context)
+        return time.perf_counter() - start
+
+    def test_preview_cost(self):
+        self.timed_run()  # warm up (imports, forkserver, file cache)
+        with_previews = min(self.timed_run() for _ in range(2))
+        with mock.patch("qmenta_sdk_tool_maker_example.tool.build_preview_pyramid", return_value=[]):
+            without_previews = min(self.timed_run() for _ in range(2))
+        added = with_previews - without_previews
+        self.assertLess(
+            added, self.MAX_ADDED_FRACTION * without_previews,
+            f"The previews add {added:.2f}s to a run of {without_previews:.2f}s"
+        )
+
+
 class TestToolDocker(unittest.TestCase):
     """
     Once the previous test is executed successfully, this test can be run using a docker container.
@@ -0,0 +1,196 @@
+import logging
+import os
+import threading
+import time
+
+
+class _Pending:
+    """A fetch in progress, shared by every caller asking for the same key."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class MetadataCache:
+    """
+    Caches the metadata requested to the platform (analysis data, file info, tags and modality).
+    Entries expire after `ttl` seconds, expired entries are removed whenever a new value is stored, so a long-lived
+    process does not keep the metadata of analyses that are never requested again. Concurrent requests for the same key are coalesced: the first caller
+    fetches the value and the rest wait for its result, so N workers asking for the same session cause one fetch.
+    Failed fetches are not cached, the error is raised to every waiting caller.
+    """
+
+    def __init__(self, ttl=300.0, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}  # key -> (expiration time, value)
+        self._pending = {}  # key -> _Pending
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch):
+        """Returns the cached value for key, calling fetch() if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self.clock():
+                self.hits += 1
+                return entry[1]
+            self._entries.pop(key, None)
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                self.misses += 1
+                pending = self._pending[key] = _Pending()
+            else:
+                self.hits += 1
+
+        if not owner:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+
+        try:
+            pending.value = fetch()
+        except Exception as e:
+            pending.error = e
+            raise
+        else:
+            with self._lock:
+                now = self.clock()
+                self._evict_expired(now)
+                self._entries[key] = (now + self.ttl, pending.value)
+            return pending.value
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.event.set()
+
+    def _evict_expired(self, now):
+        """Removes the expired entries, the lock must be held."""
+        for key in [key for key, (expiration, _) in self._entries.items() if expiration <= now]:
+            del self._entries[key]
+
+    def invalidate(self, key=None):
+        """Removes key from the cache, or all the entries if no key is given."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def fetch_analysis_data(self, context):
+        """Cached equivalent of context.fetch_analysis_data(). Not cached if the context has no analysis id."""
+        analysis_id = getattr(context, "analysis_id", None)
+        if analysis_id is None:
+            return context.fetch_analysis_data()
+        return self.get(("analysis_data", analysis_id), context.fetch_analysis_data)
+
+    def get_file_info(self, context, file_handler):
+        """Cached equivalent of file_handler.get_file_info()."""
+        return self._get_file_metadata("file_info", context, file_handler, file_handler.get_file_info)
+
+    def get_file_tags(self, context, file_handler):
+        """Cached equivalent of file_handler.get_file_tags()."""
+        return self._get_file_metadata("file_tags", context, file_handler, file_handler.get_file_tags)
+
+    def get_file_modality(self, context, file_handler):
+        """Cached equivalent of file_handler.get_file_modality()."""
+        return self._get_file_metadata("file_modality", context, file_handler, file_handler.get_file_modality)
+
+    def _get_file_metadata(self, kind, context, file_handler, fetch):
+        key = self._file_key(context, file_handler)
+        if key is None:
+            return fetch()
+        return self.get((kind,) + key, fetch)
+
+    @staticmethod
+    def _file_key(context, file_handler):
+        """
+        Identifies a platform file: the analysis id plus the platform file id, or plus the container and file name.
+        The local path alone is not enough, other analyses download files with the same name to the same folder.
+        Returns None (no caching) if the analysis is unknown.
+        """
+        analysis_id = getattr(context, "analysis_id", None)
+        if analysis_id is None:
+            return None
+        file_id = getattr(file_handler, "file_id", None)
+        if file_id is not None:
+            return analysis_id, file_id
+        # Input files are downloaded to <input folder>/<container id>/<file name>
+        container_id = getattr(file_handler, "container_id", None)
+        if container_id is None:
+            container_id = os.path.basename(os.path.dirname(file_handler.file_path))
+        file_name = getattr(file_handler, "file_name", None) or os.path.basename(file_handler.file_path)
+        return analysis_id, container_id, file_name
+
+
+class MetadataBuffer:
+    """
+    Collects the session metadata written during a run and sends it to the platform at the end.
+    Writes to the same key are merged, only the last value is sent. The context has no bulk metadata call, so each
+    distinct key still costs one request: round trips are only saved when the same key is written several times
+    (e.g. a running value updated inside a loop). A run that writes every key once saves none.
+    The buffer is flushed when leaving the `with` block, also when the run fails, or explicitly with flush() at
+    checkpoints.
+
+    Example:
+        with MetadataBuffer(context) as metadata:
+            metadata.set_metadata_value(key="volume", value=1200)
+    """
+
+    def __init__(self, context, logger=None):
+        self.context = context
+        self.logger = logger or logging.getLogger("main")
+        self.calls = 0  # calls to set_metadata_value
+        self.requests = 0  # requests sent to the platform
+        self._values = {}  # key -> keyword arguments of set_metadata_value
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # one flush at a time, a key is never written twice
+
+    @property
+    def round_trips_saved(self):
+        return self.calls - self.requests
+
+    def set_metadata_value(self, key, value, **kwargs):
+        """Same signature as context.set_metadata_value, the value is written on the next flush."""
+        with self._lock:
+            self.calls += 1
+            self._values.pop(key, None)  # keep the order of the last write
+            self._values[key] = dict(kwargs, key=key, value=value)
+
+    def flush(self):
+        """
+        Writes the buffered values. A key is removed from the buffer only once it has been written, if a write
+        fails the error is raised and the keys not written yet are kept for the next flush.
+        """
+        with self._flush_lock:
+            with self._lock:
+                values = list(self._values.items())
+            for key, kwargs in values:
+                self.context.set_metadata_value(**kwargs)
+                with self._lock:
+                    self.requests += 1
+                    if self._values.get(key) is kwargs:  # not overwritten while it was being sent
+                        del self._values[key]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+            return False
+        # The run already failed: write what can be written, without hiding the original error
+        try:
+            self.flush()
+        except Exception:
+            self.logger.exception("Session metadata could not be written")
+        return False
+
+
+# Shared by all the runs executed in the same process (batch and re-run scenarios)
+metadata_cache = MetadataCache()
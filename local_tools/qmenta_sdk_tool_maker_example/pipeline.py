@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class Stage:
+    """
+    A single step of a tool run.
+    The stage reads the values named in `inputs` and produces the values named in `outputs`. A stage without
+    outputs (e.g. an upload) is still scheduled once all its inputs are available.
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=()):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+    def call(self, values):
+        """
+        Calls the stage function with its inputs as keyword arguments and maps the returned value to the outputs.
+        A stage with a single output returns the value itself, a stage with several outputs returns a tuple.
+        """
+        result = self.func(**{name: values[name] for name in self.inputs})
+        if not self.outputs:
+            return {}
+        if len(self.outputs) == 1:
+            return {self.outputs[0]: result}
+        if not isinstance(result, tuple) or len(result) != len(self.outputs):
+            raise ValueError(f"Stage '{self.name}' must return a tuple with {len(self.outputs)} values")
+        return dict(zip(self.outputs, result))
+
+
+class StageScheduler:
+    """
+    Runs the stages of a tool as a dependency graph.
+    A stage depends on the stages that produce its inputs; independent stages run concurrently on a thread pool.
+    Use it for I/O bound steps (downloads, uploads, report rendering) which release the GIL while they wait.
+
+    Example:
+        scheduler = StageScheduler()
+        scheduler.add_stage("load", load_image, inputs=["t1_path"], outputs=["image"])
+        scheduler.add_stage("upload", upload_image, inputs=["t1_path"])
+        values = scheduler.run(initial={"t1_path": t1_path})
+    """
+
+    def __init__(self, max_workers=4, logger=None):
+        self.max_workers = max_workers
+        self.logger = logger or logging.getLogger("main")
+        self.stages = []
+        self.wall_time = 0.0
+        self._producers = {}
+
+    def add_stage(self, name, func, inputs=(), outputs=()):
+        if any(stage.name == name for stage in self.stages):
+            raise ValueError(f"Stage '{name}' is already defined")
+        stage = Stage(name, func, inputs=inputs, outputs=outputs)
+        for output in stage.outputs:
+            if output in self._producers:
+                raise ValueError(f"Output '{output}' is already produced by stage '{self._producers[output].name}'")
+            self._producers[output] = stage
+        self.stages.append(stage)
+        return stage
+
+    def dependencies(self, stage):
+        """Stages that produce the inputs of the given stage."""
+        return [self._producers[name] for name in stage.inputs if name in self._producers]
+
+    def run(self, initial=None):
+        """
+        Executes all the stages and returns the dictionary with every value produced (including `initial`).
+        If a stage fails, no new stages are started, the running ones are waited for and the first error is raised.
+        """
+        values = dict(initial or {})
+        for stage in self.stages:
+            missing = [name for name in stage.inputs if name not in values and name not in self._producers]
+            if missing:
+                raise ValueError(f"Stage '{stage.name}' requires {missing}, which no stage produces")
+
+        lock = threading.Lock()  # protects the values dictionary, stages run in several threads
+        pending = list(self.stages)
+        running = {}
+        error = None
+        t_start = time.perf_counter()
+
+        def execute(stage):
+            with lock:
+                stage_values = {name: values[name] for name in stage.inputs}
+            stage.start = time.perf_counter()
+            try:
+                return stage.call(stage_values)
+            finally:
+                stage.end = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if error is None:
+                    with lock:
+                        ready = [stage for stage in pending if all(name in values for name in stage.inputs)]
+                    for stage in ready:
+                        pending.remove(stage)
+                        self.logger.debug(f"Stage '{stage.name}' started")
+                        running[executor.submit(execute, stage)] = stage
+                if not running:
+                    if error is None:
+                        raise ValueError(f"Stages {[stage.name for stage in pending]} have circular dependencies")
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    exception = future.exception()
+                    if exception is not None:
+                        self.logger.error(f"Stage '{stage.name}' failed: {exception}")
+                        error = error or exception
+                        continue
+                    self.logger.debug(f"Stage '{stage.name}' finished in {stage.duration:.2f}s")
+                    with lock:
+                        values.update(future.result())
+
+        self.wall_time = time.perf_counter() - t_start
+        if error is not None:
+            raise error
+        return values
+
+    def critical_path(self):
+        """
+        Returns the chain of stages with the longest accumulated duration and that duration.
+        This is the minimum wall time of the run regardless of how many stages can run concurrently.
+        """
+        longest = {}  # stage name -> (accumulated duration, path)
+        for stage in self._topological_order():
+            best = max((longest[dep.name] for dep in self.dependencies(stage)), key=lambda x: x[0], default=(0.0, []))
+            longest[stage.name] = (best[0] + stage.duration, best[1] + [stage.name])
+        duration, path = max(longest.values(), key=lambda x: x[0], default=(0.0, []))
+        return path, duration
+
+    def summary(self):
+        """Human readable timing report: stage durations, critical path and wall time."""
+        lines = [f"{stage.name}: {stage.duration:.2f}s" for stage in self.stages]
+        path, duration = self.critical_path()
+        lines.append(f"Critical path ({duration:.2f}s): {' -> '.join(path)}")
+        lines.append(f"Wall time: {self.wall_time:.2f}s")
+        return "\n".join(lines)
+
+    def _topological_order(self):
+        order = []
+        visited = set()
+
+        def visit(stage):
+            if stage.name in visited:
+                return
+            visited.add(stage.name)
+            for dep in self.dependencies(stage):
+                visit(dep)
+            order.append(stage)
+
+        for stage in self.stages:
+            visit(stage)
+        return order
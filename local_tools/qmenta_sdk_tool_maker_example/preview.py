@@ -0,0 +1,66 @@
+import itertools
+import os
+
+import nibabel as nib
+import numpy as np
+
+
+def downsample_affine(affine, factor):
+    """Affine of a volume block-averaged by factor: larger voxels centred on the blocks they average."""
+    new_affine = np.array(affine, dtype=float)
+    new_affine[:3, 3] += affine[:3, :3] @ np.full(3, (factor - 1) / 2)
+    new_affine[:3, :3] *= factor
+    return new_affine
+
+
+def block_average(data, factor):
+    """
+    Averages blocks of factor x factor x factor voxels, the spatial dimensions must be multiples of factor.
+    Extra dimensions (e.g. time points) are kept.
+    The strided views of the volume are accumulated in place, which is several times faster than a reshape
+    followed by mean() over the block axes.
+    """
+    offsets = itertools.product(range(factor), repeat=3)
+    total = np.array(data[::factor, ::factor, ::factor], dtype=np.float32)
+    next(offsets)  # (0, 0, 0) is already in total
+    for i, j, k in offsets:
+        total += data[i::factor, j::factor, k::factor]
+    total /= factor ** 3
+    return total
+
+
+def build_preview_pyramid(source, out_folder, prefix, factors=(2, 4)):
+    """
+    Writes block-averaged versions of the NIfTI file (path or already loaded nibabel image), one for each downsampling factor (e.g. 2x and 4x), to be
+    loaded by the viewer before the full resolution image.
+    The full resolution volume is read and averaged once, each coarser level is averaged from the previous one.
+    The volume is padded (repeating the edge voxels) to a multiple of the largest factor, so no voxel is dropped.
+    Returns a list of (factor, path) tuples, from the finest to the coarsest level.
+    """
+    factors = sorted(factors)
+    if any(factor % previous for previous, factor in zip([1] + factors, factors)):
+        raise ValueError(f"Each factor must be a multiple of the previous one, got {factors}")
+
+    image = nib.load(source) if isinstance(source, str) else source
+    data = image.get_fdata(dtype=np.float32)  # cached, not decoded again if another stage already read it
+    padding = [(0, -size % factors[-1]) for size in data.shape[:3]] + [(0, 0)] * (data.ndim - 3)
+    if any(after for _, after in padding):
+        data = np.pad(data, padding, mode="edge")
+
+    pyramid = []
+    level, affine, previous = data, image.affine, 1
+    for factor in factors:
+        level = block_average(level, factor // previous)
+        affine = downsample_affine(affine, factor // previous)
+        previous = factor
+
+        level_path = os.path.join(out_folder, f"{prefix}_preview_{factor}x.nii.gz")
+        # Same data type as the input (with scaling for integer types), previews of int16 images stay small
+        level_image = nib.Nifti1Image(level, affine, header=image.header)
+        # Keep the orientation codes of the input (e.g. scanner), so the previews and the full resolution image are
+        # shown in the same coordinate system
+        level_image.set_qform(affine, code=int(image.header["qform_code"]))
+        level_image.set_sform(affine, code=int(image.header["sform_code"]))
+        nib.save(level_image, level_path)
+        pyramid.append((factor, level_path))
+    return pyramid
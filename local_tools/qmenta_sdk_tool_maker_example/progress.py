@@ -0,0 +1,88 @@
+import threading
+import time
+
+
+class ProgressReporter:
+    """
+    Forwards progress updates to context.set_progress from a background thread.
+    The first update of a stage is sent right away, so every stage shows up in the platform. The following updates
+    of the same stage only store the latest state, so they can be called inside hot loops (per slice, per
+    timepoint): the background thread sends at most `max_per_second` of them, intermediate updates are coalesced
+    and only the most recent one is sent. The last update is always sent when the reporter stops.
+    update() can be called from several threads, e.g. concurrent pipeline stages.
+
+    Example:
+        with ProgressReporter(context) as progress:
+            for i in range(n_slices):
+                progress.update(stage="Segmentation", fraction=(i + 1) / n_slices)
+    """
+
+    def __init__(self, context, max_per_second=1.0, clock=time.monotonic):
+        self.context = context
+        self.interval = 1.0 / max_per_second
+        self.clock = clock
+        self.sent = 0  # messages sent to the platform
+        self._latest = None  # (stage, message, fraction, seconds since the stage started), replaced atomically
+        self._last_sent = None
+        self._stage = None
+        self._stage_start = None
+        self._lock = threading.Lock()  # protects the current stage and its start time
+        self._send_lock = threading.Lock()  # one message sent at a time
+        self._stop = threading.Event()
+        self._thread = None
+
+    def update(self, message=None, stage=None, fraction=None):
+        """Records the current progress. `fraction` is a number between 0 and 1 used to estimate the ETA."""
+        now = self.clock()
+        with self._lock:
+            new_stage = stage != self._stage or self._stage_start is None
+            if new_stage:
+                self._stage, self._stage_start = stage, now
+            self._latest = (stage, message, fraction, now - self._stage_start)
+        if new_stage:
+            self.flush()
+
+    @staticmethod
+    def format(stage, message, fraction, elapsed):
+        """Builds the text shown in the platform, e.g. 'Segmentation: slice 10 (25%, ETA 30s)'."""
+        text = ": ".join(str(part) for part in (stage, message) if part is not None)
+        if fraction is not None:
+            details = f"{fraction:.0%}"
+            if 0 < fraction < 1 and elapsed > 0:
+                details += f", ETA {elapsed * (1 - fraction) / fraction:.0f}s"
+            text = f"{text} ({details})" if text else details
+        return text
+
+    def flush(self):
+        """Sends the latest update if it has not been sent yet."""
+        with self._send_lock:
+            latest = self._latest
+            if latest is None or latest is self._last_sent:
+                return
+            self._last_sent = latest
+            self.context.set_progress(message=self.format(*latest))
+            self.sent += 1
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._forward, name="progress-reporter", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _forward(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
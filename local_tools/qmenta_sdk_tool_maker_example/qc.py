@@ -0,0 +1,134 @@
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import nibabel as nib
+import numpy as np
+
+
+class SharedVolume:
+    """
+    Picklable handle of a volume stored in shared memory.
+    Worker processes attach to the block by name and read the voxels in place, the array itself is never pickled.
+    """
+
+    def __init__(self, modality, name, shape, dtype):
+        self.modality = modality
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    @classmethod
+    def load(cls, modality, source):
+        """
+        Copies a NIfTI file (path) or an already loaded nibabel image into a new shared memory block. 4D images
+        (e.g. DWI) keep only their first volume.
+        Returns the handle and the SharedMemory object, which the caller must close and unlink.
+        """
+        if isinstance(source, str):
+            dataobj = nib.load(source).dataobj
+            if len(dataobj.shape) > 3:
+                dataobj = dataobj[..., 0]
+            data = np.asanyarray(dataobj)
+        else:
+            # get_fdata caches the data, the image is not decoded again if another stage already read it
+            data = source.get_fdata(dtype=np.float32)
+            if data.ndim > 3:
+                data = data[..., 0]
+        dtype = np.dtype(np.float32)
+        shm = shared_memory.SharedMemory(create=True, size=max(data.size * dtype.itemsize, 1))
+        np.ndarray(data.shape, dtype=dtype, buffer=shm.buf)[...] = data
+        return cls(modality, shm.name, data.shape, dtype.str), shm
+
+    def attach(self):
+        """Returns the SharedMemory block and a read-only array view of it."""
+        shm = shared_memory.SharedMemory(name=self.name)
+        data = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+        data.flags.writeable = False
+        return shm, data
+
+
+# Ratio between the standard deviation of the background of a magnitude image (Rayleigh distributed) and the
+# standard deviation of the noise in the complex data: sqrt(2 - pi / 2)
+RAYLEIGH_STD_FACTOR = np.sqrt(2 - np.pi / 2)
+
+
+def noise_std(data, patch_fraction=0.1):
+    """
+    Estimates the standard deviation of the image noise from the air background in the 8 corner patches of the
+    volume (each patch spans `patch_fraction` of every dimension), corrected for the Rayleigh distribution of the
+    background of magnitude images.
+    Returns NaN if the corners are constant, e.g. images that were skull-stripped or masked.
+    """
+    sizes = [max(1, int(size * patch_fraction)) for size in data.shape[:3]]
+    corners = [
+        data[tuple(slice(0, size) if low else slice(-size, None) for size, low in zip(sizes, corner))].ravel()
+        for corner in itertools.product((True, False), repeat=3)
+    ]
+    background_std = float(np.concatenate(corners).std())
+    return float(background_std / RAYLEIGH_STD_FACTOR) if background_std > 0 else float("nan")
+
+
+def volume_statistics(volume, hist_start, hist_end, bin_width=50):
+    """
+    Computes the QC statistics of a volume, meant to run in a worker process.
+    Zero voxels are excluded from the histogram (as in the T1 histogram). The foreground are the voxels brighter
+    than the mean non-zero intensity. The SNR is the mean foreground intensity divided by the noise standard
+    deviation estimated from the air background (see noise_std).
+    """
+    shm, data = volume.attach()
+    try:
+        voxels = data[data != 0]
+        threshold = voxels.mean() if voxels.size else 0.0
+        foreground = voxels[voxels > threshold]
+        counts, edges = np.histogram(voxels, bins=np.arange(hist_start, hist_end, bin_width))
+        foreground_mean = float(foreground.mean()) if foreground.size else 0.0
+        noise = noise_std(data)
+        return {
+            "modality": volume.modality,
+            "shape": tuple(int(size) for size in volume.shape),
+            "foreground_voxels": int(foreground.size),
+            "foreground_mean": foreground_mean,
+            "foreground_std": float(foreground.std()) if foreground.size else 0.0,
+            "noise_std": noise,
+            "snr": foreground_mean / noise if noise > 0 else float("nan"),
+            "histogram_counts": counts.tolist(),
+            "histogram_edges": edges.tolist(),
+        }
+    finally:
+        del data  # the view must be released before closing the block
+        shm.close()
+
+
+def run_qc(paths, hist_start, hist_end, max_workers=None):
+    """
+    Computes the QC statistics of several modalities in parallel.
+    `paths` maps each modality name to its NIfTI file (or to an already loaded nibabel image). The files are read concurrently into shared memory, then one
+    process per modality computes the statistics, so the wall time is close to the one of the slowest modality.
+    Returns a dictionary with the statistics of each modality, in the order of `paths`.
+    The workers are started with the forkserver method: a script calling run_qc directly needs the usual
+    `if __name__ == "__main__":` guard.
+    """
+    if not paths:
+        return {}
+    max_workers = max_workers or min(len(paths), os.cpu_count() or 1)
+    blocks = []
+    try:
+        with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+            loading = [executor.submit(SharedVolume.load, modality, path) for modality, path in paths.items()]
+        # Keep track of every block created before raising a loading error, so none of them is leaked
+        blocks = [future.result()[1] for future in loading if future.exception() is None]
+        volumes = [future.result()[0] for future in loading]
+        # run_qc is called from a pipeline thread while other threads (uploads, progress, I/O) are running. Forking a
+        # multithreaded process can deadlock the child on a lock held by another thread, so the workers are started
+        # from a forkserver instead. The SharedVolume handles are picklable, only their names are sent.
+        mp_context = multiprocessing.get_context("forkserver")
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+            futures = [executor.submit(volume_statistics, volume, hist_start, hist_end) for volume in volumes]
+            return {volume.modality: future.result() for volume, future in zip(volumes, futures)}
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
@@ -22,6 +22,19 @@ from qmenta.sdk.tool_maker.outputs import (
 from qmenta.sdk.tool_maker.modalities import Modality
 from qmenta.sdk.tool_maker.tool_maker import InputFile, Tool, FilterFile
 
+try:  # imported as part of the tool folder (local tests)
+    from .metadata import MetadataBuffer, metadata_cache
+    from .pipeline import StageScheduler
+    from .progress import ProgressReporter
+    from .preview import build_preview_pyramid
+    from .qc import run_qc
+except ImportError:  # tool.py next to its helper modules in the Docker image
+    from metadata import MetadataBuffer, metadata_cache
+    from pipeline import StageScheduler
+    from progress import ProgressReporter
+    from preview import build_preview_pyramid
+    from qc import run_qc
+
 # This backend config avoids $DISPLAY errors in headless machines
 matplotlib.use('Agg')
 
@@ -35,8 +48,9 @@ class QmentaSdkToolMakerExample(Tool):
         """
         # Add the file selection method:
         self.add_input_container(
-            title="T1 weighted image",
-            info="Describe here what is the expected input, this will appear in the tool UI.",
+            title="Structural and diffusion images",
+            info="A T1 weighted image is required. T2, FLAIR and DWI images are optional and included in the QC "
+                 "report when available.",
             anchor=1,
             batch=1,
             container_id="input",
@@ -54,6 +68,34 @@ class QmentaSdkToolMakerExample(Tool):
                     min_files=1,
                     max_files=1,
                 ),
+                # Optional modalities, the QC statistics are computed for every file selected
+                InputFile(
+                    file_filter_condition_name="c_T2",
+                    filter_file=FilterFile(
+                        modality=Modality.T2
+                    ),
+                    mandatory=0,
+                    min_files=0,
+                    max_files=1,
+                ),
+                InputFile(
+                    file_filter_condition_name="c_FLAIR",
+                    filter_file=FilterFile(
+                        modality=Modality.FLAIR
+                    ),
+                    mandatory=0,
+                    min_files=0,
+                    max_files=1,
+                ),
+                InputFile(
+                    file_filter_condition_name="c_DWI",
+                    filter_file=FilterFile(
+                        modality=Modality.DWI
+                    ),
+                    mandatory=0,
+                    min_files=0,
+                    max_files=1,
+                ),
             ],
         )
 
@@ -74,100 +116,191 @@ class QmentaSdkToolMakerExample(Tool):
     def run(self, context):
         """
         This is the main function that is called when the tool is run.
+        The steps are declared as stages of a StageScheduler: each stage declares the values it needs and the ones it
+        produces, so independent steps (e.g. uploading the histogram while the report is rendered) run concurrently.
         """
         # ================ #
         # GETTING THINGS READY
         logger = logging.getLogger("main")
         logger.info("Tool starting")
 
-        # Downloads all the files and populate the variable self.inputs with the handlers and parameters
-        context.set_progress(message="Downloading input data and setting self.inputs object")
-        analysis_data = context.fetch_analysis_data()
-        self.prepare_inputs(context, logger)
-        # Input handlers are built as simplenamespaces, each attribute is the "id" defined in each InputFile
-        # THESE ARE LISTS, each element has the methods to get modality, tags, file_info
-        schema_file = self.inputs.input.c_T1
-
-        schema_file_path = schema_file[0].file_path  # getting the first element of the file handler list
-
-        schema_file_modality = schema_file[0].get_file_modality()
-        schema_file_tags = schema_file[0].get_file_tags()
-        schema_file_file_info = schema_file[0].get_file_info()
-
-        logger.info(
-            f"Input file data."
-            f"Path : {schema_file_path}"
-            f"Modality: {schema_file_modality}"
-            f"Tags: {schema_file_tags}"
-            f"INFO: {schema_file_file_info}"
-        )
-
-        # Parameters are also accessible through the self.inputs object
-        hist_start = self.inputs.hist_start
-        hist_end = self.inputs.hist_end
-        logger.info(f"histogram start : {hist_start}")
-        logger.info(f"Parameter decimal : {hist_end}")
-
         # Working directory
         working_dir = os.environ.get("WORKDIR")  # from Dockerfile, feel free to modify
         out_folder = os.path.join(working_dir, "OUTPUT")
         os.makedirs(out_folder, exist_ok=True)
 
+        scheduler = StageScheduler(logger=logger)
+        # Progress updates are cheap to report, a background thread forwards them to context.set_progress
+        progress = ProgressReporter(context, max_per_second=1)
+        # Session metadata is buffered and written in one go at the end of the run, even if a stage fails.
+        # Use metadata.flush() to write the values collected so far at a checkpoint.
+        metadata = MetadataBuffer(context)
+
+        def fetch_analysis_data():
+            # The analysis metadata is cached, re-runs in the same process do not request it again
+            return metadata_cache.fetch_analysis_data(context)
+
+        def prepare_inputs():
+            # Downloads all the files and populate the variable self.inputs with the handlers and parameters
+            progress.update(stage="Downloading input data and setting self.inputs object")
+            self.prepare_inputs(context, logger)
+            # Input handlers are built as simplenamespaces, each attribute is the "id" defined in each InputFile
+            # THESE ARE LISTS, each element has the methods to get modality, tags, file_info
+            schema_file = self.inputs.input.c_T1
+
+            schema_file_path = schema_file[0].file_path  # getting the first element of the file handler list
+
+            schema_file_modality = metadata_cache.get_file_modality(context, schema_file[0])
+            schema_file_tags = metadata_cache.get_file_tags(context, schema_file[0])
+            schema_file_file_info = metadata_cache.get_file_info(context, schema_file[0])
+
+            logger.info(
+                f"Input file data."
+                f"Path : {schema_file_path}"
+                f"Modality: {schema_file_modality}"
+                f"Tags: {schema_file_tags}"
+                f"INFO: {schema_file_file_info}"
+            )
+
+            # Every modality selected is included in the QC, the optional ones can have no files
+            qc_paths = {"T1": schema_file_path}
+            for modality in ("T2", "FLAIR", "DWI"):
+                handlers = getattr(self.inputs.input, f"c_{modality}", None)
+                if handlers:
+                    qc_paths[modality] = handlers[0].file_path
+            logger.info(f"QC modalities : {list(qc_paths)}")
+
+            # Parameters are also accessible through the self.inputs object
+            hist_start = self.inputs.hist_start
+            hist_end = self.inputs.hist_end
+            logger.info(f"histogram start : {hist_start}")
+            logger.info(f"Parameter decimal : {hist_end}")
+            return schema_file_path, qc_paths, hist_start, hist_end
+
         # ================##
         # YOUR CODE HERE
-        context.set_progress(message="Processing...")
-        t1_path = schema_file_path
-        hist_vect = nib.load(t1_path).get_fdata().flatten()
-        hist_vect[hist_vect == 0] = np.nan
-        # Plot the histogram for the selected range of intensities
-        fig, ax = plt.subplots()
-        ax.set_title("T1 Histogram (for intensities between 50 and 400)")
-        ax.set_ylabel("Number of voxels")
-        ax.grid(color="#CCCCCC", linestyle="--", linewidth=1)
-
-        ax.hist(hist_vect, bins=np.arange(hist_start, hist_end, 50))
-
-        hist_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "hist.png")
-        fig.savefig(hist_path)
-        context.upload_file(
-            source_file_path=hist_path,  # path to the output file in Docker container
-            destination_path="hist.png",  # path of the file saved in the output container in the platform
-        )
-        # Generate an example report
-        # Since it is a head-less machine, it requires Xvfb to generate the pdf
-        context.set_progress(message="Creating report...")
-        report_path = os.path.join(working_dir, "report.pdf")
-        data_report = {
-            "logo_main": "/root/qmenta_logo.png",
-            "ss": analysis_data["patient_secret_name"],
-            "ssid": analysis_data["ssid"],
-            "histogram": hist_path,
-            "this_moment": strftime("%Y-%m-%d %H:%M:%S", gmtime()),
-            "version": 1.0
-        }
-
-        loader = template.Loader(os.path.dirname(os.path.realpath(__file__)))
-        report_contents = loader.load("report_template.html").generate(data_report=data_report)
-
-        if isinstance(report_contents, bytes):
-            report_contents = report_contents.decode("utf-8")
-        pdfkit.from_string(report_contents, report_path, options={"enable-local-file-access": ""})
-        context.set_progress(message="Uploading results...")
-        context.upload_file(
-            source_file_path=report_path,  # path to the output file in Docker container
-            destination_path=os.path.basename(report_path),  # path of the file saved in the output container in the platform
-            tags={"report"}
-        )
+        def load_t1(t1_path):
+            # The T1 is decoded once (get_fdata caches the data), the QC and the previews both read it
+            t1_image = nib.load(t1_path)
+            t1_image.get_fdata(dtype=np.float32)
+            return t1_image
+
+        def quality_control(qc_paths, t1_image, hist_start, hist_end):
+            # The statistics of each modality are computed in a separate process, the volumes are shared through
+            # shared memory, so the wall time is close to the one of the slowest modality.
+            progress.update(stage=f"Computing QC statistics for {', '.join(qc_paths)}...")
+            qc_stats = run_qc(dict(qc_paths, T1=t1_image), hist_start, hist_end)
+            for modality, stats in qc_stats.items():
+                logger.info(f"{modality} QC: SNR {stats['snr']:.2f}, foreground voxels {stats['foreground_voxels']}")
+                if np.isfinite(stats["snr"]):
+                    metadata.set_metadata_value(key=f"{modality.lower()}_snr", value=round(stats["snr"], 2))
+            return qc_stats
+
+        def histogram(qc_stats, hist_start, hist_end):
+            progress.update(stage="Processing...")
+            # Plot the histogram of every modality for the selected range of intensities
+            fig, axes = plt.subplots(len(qc_stats), 1, figsize=(6.4, 3.6 * len(qc_stats)), squeeze=False)
+            for ax, (modality, stats) in zip(axes[:, 0], qc_stats.items()):
+                ax.set_title(f"{modality} Histogram (for intensities between {hist_start} and {hist_end})")
+                ax.set_ylabel("Number of voxels")
+                ax.grid(color="#CCCCCC", linestyle="--", linewidth=1)
+
+                # The counts are already computed, each bin is drawn with its count as weight
+                edges = stats["histogram_edges"]
+                ax.hist(edges[:-1], bins=edges, weights=stats["histogram_counts"])
+            fig.tight_layout()
+
+            hist_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "hist.png")
+            fig.savefig(hist_path)
+            plt.close(fig)
+            return hist_path
+
+        def upload_histogram(hist_path):
+            context.upload_file(
+                source_file_path=hist_path,  # path to the output file in Docker container
+                destination_path="hist.png",  # path of the file saved in the output container in the platform
+            )
+
+        def report(analysis_data, hist_path, qc_stats):
+            # Generate an example report
+            # Since it is a head-less machine, it requires Xvfb to generate the pdf
+            progress.update(stage="Creating report...")
+            report_path = os.path.join(working_dir, "report.pdf")
+            data_report = {
+                "logo_main": "/root/qmenta_logo.png",
+                "ss": analysis_data["patient_secret_name"],
+                "ssid": analysis_data["ssid"],
+                "histogram": hist_path,
+                "qc": list(qc_stats.values()),
+                "this_moment": strftime("%Y-%m-%d %H:%M:%S", gmtime()),
+                "version": 1.0
+            }
+
+            loader = template.Loader(os.path.dirname(os.path.realpath(__file__)))
+            report_contents = loader.load("report_template.html").generate(data_report=data_report)
+
+            if isinstance(report_contents, bytes):
+                report_contents = report_contents.decode("utf-8")
+            pdfkit.from_string(report_contents, report_path, options={"enable-local-file-access": ""})
+            return report_path
+
+        def upload_report(report_path):
+            progress.update(stage="Uploading results...")
+            context.upload_file(
+                source_file_path=report_path,  # path to the output file in Docker container
+                destination_path=os.path.basename(report_path),  # path of the file saved in the output container in the platform
+                tags={"report"}
+            )
+        # ================##
+
+        def preview_pyramid(t1_image):
+            # Block-averaged 2x and 4x versions of the T1, the results screen opens on them (see tool_outputs)
+            progress.update(stage="Creating preview images...")
+            return build_preview_pyramid(t1_image, out_folder, prefix="T1")
+
+        def upload_previews(preview_paths):
+            for factor, preview_path in preview_paths:
+                context.upload_file(
+                    source_file_path=preview_path,  # path to the output file in Docker container
+                    destination_path=os.path.basename(preview_path),  # path of the file saved in the output container in the platform
+                    modality=str(Modality.T1),  # modality that will be set for that file
+                    tags={"preview", f"preview_{factor}x"}  # tags that will be set for that file
+                )
         # ================##
 
         # PREPARE AND UPLOAD YOUR RESULTS Example:
-        context.set_progress(message="Uploading result")
-        context.upload_file(
-            source_file_path=t1_path,  # path to the output file in Docker container
-            destination_path="T1_final.nii.gz",  # path of the file saved in the output container in the platform
-            modality=str(Modality.T1),  # modality that will be set for that file
+        def upload_t1(t1_path):
+            progress.update(stage="Uploading result")
+            context.upload_file(
+                source_file_path=t1_path,  # path to the output file in Docker container
+                destination_path="T1_final.nii.gz",  # path of the file saved in the output container in the platform
+                modality=str(Modality.T1),  # modality that will be set for that file
+            )
+
+        # The order in which stages are added does not matter, they start as soon as their inputs are available.
+        scheduler.add_stage("fetch_analysis_data", fetch_analysis_data, outputs=["analysis_data"])
+        scheduler.add_stage(
+            "prepare_inputs", prepare_inputs, outputs=["t1_path", "qc_paths", "hist_start", "hist_end"]
         )
-        context.set_metadata_value(key="metadata_key", value=100)  # metadata value added to the session metadata
+        scheduler.add_stage("load_t1", load_t1, inputs=["t1_path"], outputs=["t1_image"])
+        scheduler.add_stage(
+            "quality_control", quality_control, inputs=["qc_paths", "t1_image", "hist_start", "hist_end"],
+            outputs=["qc_stats"]
+        )
+        scheduler.add_stage("histogram", histogram, inputs=["qc_stats", "hist_start", "hist_end"], outputs=["hist_path"])
+        scheduler.add_stage("upload_histogram", upload_histogram, inputs=["hist_path"])
+        scheduler.add_stage(
+            "report", report, inputs=["analysis_data", "hist_path", "qc_stats"], outputs=["report_path"]
+        )
+        scheduler.add_stage("upload_report", upload_report, inputs=["report_path"])
+        scheduler.add_stage("upload_t1", upload_t1, inputs=["t1_path"])
+        scheduler.add_stage("preview_pyramid", preview_pyramid, inputs=["t1_image"], outputs=["preview_paths"])
+        scheduler.add_stage("upload_previews", upload_previews, inputs=["preview_paths"])
+        with metadata, progress:
+            scheduler.run()
+            logger.info(f"Stage timings:\n{scheduler.summary()}")
+
+            metadata.set_metadata_value(key="metadata_key", value=100)  # metadata value added to the session metadata
         # ================##
 
     def tool_outputs(self):
@@ -177,16 +310,35 @@ class QmentaSdkToolMakerExample(Tool):
         # Add the tools to visualize files using the function add_visualization
 
         # Online 3D volume viewer: visualize DICOM or NIfTI files.
-        papaya_1 = PapayaViewer(title="Tissue segmentation over T1", width="50%", region=Region.center)
+        # The first viewer shows the 4x downsampled preview, which is much faster to download and decode than the
+        # full resolution image. The 2x and full resolution images are in the next tabs.
+        papaya_1 = PapayaViewer(
+            title="T1 preview (4x downsampled)", width="50%", region=Region.center, button_label="Preview"
+        )
         # the first viewer's region is defined as center
 
         # Add as many layers as you want, they are going to be loaded in the order that you add them.
-        papaya_1.add_file(file="T1_final.nii.gz", coloring=Coloring.grayscale)
+        papaya_1.add_file(file="T1_preview_4x.nii.gz", coloring=Coloring.grayscale)
         # Add the papaya element as a visualization in the results configuration object.
         result_conf.add_visualization(new_element=papaya_1)
+
+        papaya_2 = PapayaViewer(
+            title="T1 preview (2x downsampled)", width="50%", region=Region.center, button_label="Half resolution"
+        )
+        papaya_2.add_file(file="T1_preview_2x.nii.gz", coloring=Coloring.grayscale)
+        result_conf.add_visualization(new_element=papaya_2)
+
+        papaya_3 = PapayaViewer(
+            title="Tissue segmentation over T1", width="50%", region=Region.center, button_label="Full resolution"
+        )
+        papaya_3.add_file(file="T1_final.nii.gz", coloring=Coloring.grayscale)
+        result_conf.add_visualization(new_element=papaya_3)
+
+        # Remember to add the button_label in the child objects of the tab.
+        tab_1 = Tab(children=[papaya_1, papaya_2, papaya_3])
         # tool path
         result_conf.generate_results_configuration_file(
-            build_screen=papaya_1, tool_path=self.tool_path, testing_configuration=False
+            build_screen=tab_1, tool_path=self.tool_path, testing_configuration=False
         )
 
         return result_conf